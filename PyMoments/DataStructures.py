@@ -3,6 +3,10 @@ DataStructures.py
 Module of custom data structures for statistics computation.
 """
 
+from collections import OrderedDict
+import weakref
+import numpy as np
+
 
 class IntPartitionTree:
     """
@@ -145,3 +149,191 @@ class IntPartitionTree:
             if child is not None:
                 max_ancestor_depth = max(max_ancestor_depth, child.depth())
         return max_ancestor_depth + 1
+
+
+class ProductTrie:
+    """
+    Data structure for caching elementwise products of columns of a data array.
+    Products are associated with sorted multisets of column indices, and looked up in the following manner:
+        1. Sort the column indices in ascending order.
+        2. Look up the child node of the root node associated with the first index.
+        3. Recursively apply step 2, until the deepest node with a cached product is reached.
+    The remaining columns are then multiplied onto the cached product, so that a block of columns whose
+    prefix has been cached costs one multiplication per remaining column, rather than |block| - 1.
+
+    Attributes
+    ----------
+    max_bytes : int
+        Maximum total size (in bytes) of the cached products.
+    min_count : int
+        Number of times that a prefix must be requested before its product is cached.
+    n_bytes : int
+        Total size (in bytes) of the currently cached products.
+    root : _ProductTrieNode
+        Root node of the trie, associated with the empty product.
+    cache : OrderedDict
+        Nodes with cached products, keyed by their sorted column indices, in least-recently-used order.
+    data_ref : weakref.ref or None
+        Reference to the data array with which the cached products were computed.
+    data_signature : tuple or None
+        Shape of the data, variable axis and accumulation dtype with which the cached products were computed.
+
+    Methods
+    -------
+    product(data, block, variable_axis, out)
+        Compute the elementwise product of a block of columns, reusing cached partial products.
+    n_entries()
+        Count the number of cached products.
+    clear()
+        Remove all cached products.
+
+    Notes
+    -----
+    The cached products are only valid for the data array (and accumulation dtype) with which
+    they were computed. The trie is cleared automatically whenever it is used with a different
+    data array, variable axis or dtype, but not if the same data array is modified in-place.
+    """
+
+    def __init__(self, max_bytes=2 ** 26, min_count=2):
+        """
+        Initialize an empty ProductTrie.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Maximum total size (in bytes) of the cached products. Default is 64 MiB.
+            When the budget is exceeded, the least recently used products are evicted.
+            Set to 0 to disable caching.
+        min_count : int, optional
+            Number of times that a prefix must be requested before its product is cached.
+            Default is 2, so that only prefixes shared by at least two blocks are stored.
+        """
+        self.max_bytes = max_bytes
+        self.min_count = min_count
+        self.n_bytes = 0
+        self.root = _ProductTrieNode()
+        self.cache = OrderedDict()
+        self.data_ref = None
+        self.data_signature = None
+
+    def product(self, data, block, variable_axis, out):
+        """
+        Compute the elementwise product of a block of columns of the data.
+
+        Parameters
+        ----------
+        data : NumPy array
+            Array of input data.
+        block : sequence of ints
+            Indices along the variable axis of the columns to multiply.
+        variable_axis : int
+            Axis of the data array corresponding to different modes / random variables.
+        out : NumPy array
+            Scratch array, with the shape of the data array after removing the variable axis.
+            The product is accumulated in the dtype of this array.
+
+        Returns
+        -------
+        p : NumPy array
+            The elementwise product of the columns. This is either out, or a cached array,
+            which must not be modified.
+        """
+        signature = (data.shape, variable_axis, out.dtype)
+        if self.data_ref is None or self.data_ref() is not data or self.data_signature != signature:
+            self.clear()
+            self.data_ref = weakref.ref(data)
+            self.data_signature = signature
+        key = tuple(sorted(block))
+        slice_left = (slice(None),) * variable_axis
+
+        # Walk down the trie, recording the deepest prefix with a cached product
+        path = []
+        node, cached_depth = self.root, 0
+        for col in key:
+            node = node.children.setdefault(col, _ProductTrieNode())
+            node.count += 1
+            path.append(node)
+            if node.value is not None:
+                cached_depth = len(path)
+        if cached_depth == len(key):
+            self.cache.move_to_end(key)
+            return node.value
+
+        # Start from the cached prefix, or from the first column
+        if cached_depth == 0:
+            if len(key) == 1:
+                np.copyto(out, data[slice_left + (key[0],)], casting='same_kind')
+                return out
+            product = data[slice_left + (key[0],)]
+            cached_depth = 1
+        else:
+            self.cache.move_to_end(key[:cached_depth])
+            product = path[cached_depth - 1].value
+
+        # Multiply the remaining columns, into a new buffer (owned by the trie) for prefixes that will be cached
+        for i in range(cached_depth, len(key)):
+            store = path[i].count >= self.min_count and out.nbytes <= self.max_bytes
+            target = self._reserve(out) if store else out
+            np.multiply(product, data[slice_left + (key[i],)], out=target, dtype=out.dtype)
+            if store:
+                path[i].value = target
+                self.cache[key[:i + 1]] = path[i]
+                self.n_bytes += target.nbytes
+            product = target
+        return product
+
+    def _reserve(self, like):
+        """
+        Make room for a new cached product with the shape and dtype of the given array, evicting the
+        least recently used products to stay within the byte budget. Returns an array for the product,
+        recycling an evicted array if possible, so that large buffers are not repeatedly allocated.
+        """
+        recycled = None
+        while self.n_bytes + like.nbytes > self.max_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.n_bytes -= evicted.value.nbytes
+            if evicted.value.shape == like.shape and evicted.value.dtype == like.dtype:
+                recycled = evicted.value
+            evicted.value = None
+        return np.empty_like(like) if recycled is None else recycled
+
+    def n_entries(self):
+        """
+        Count the number of cached products.
+
+        Returns
+        -------
+        n : int
+            Number of cached products.
+        """
+        return len(self.cache)
+
+    def clear(self):
+        """
+        Remove all cached products, and reset the request counts.
+        """
+        self.root = _ProductTrieNode()
+        self.cache = OrderedDict()
+        self.n_bytes = 0
+        self.data_ref = None
+        self.data_signature = None
+
+
+class _ProductTrieNode:
+    """
+    Node of a ProductTrie.
+
+    Attributes
+    ----------
+    count : int
+        Number of times that the prefix ending at this node has been requested.
+    value : NumPy array or None
+        Cached product of the prefix ending at this node, or None if it is not cached.
+    children : dict
+        Child nodes, keyed by column index.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.value = None
+        self.children = {}
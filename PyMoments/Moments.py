@@ -8,7 +8,8 @@ from PyMoments.Combinatorics import *
 from PyMoments.DataStructures import *
 
 
-def kstat(data, modes, sample_axis=0, variable_axis=1, coef_tree=None):
+def kstat(data, modes, sample_axis=0, variable_axis=1, coef_tree=None,
+          dtype=None, summation='pairwise', out=None, scratch=None, product_trie=None, terms_tree=None):
     """
     Compute a multivariate k-statistic.
 
@@ -27,8 +28,31 @@ def kstat(data, modes, sample_axis=0, variable_axis=1, coef_tree=None):
     coef_tree : IntPartitionTree, optional
         Efficient data structure to memoize coefficients in the computation.
         When evaluating many k-stats on the same data, this tree may be re-used to reduce runtime.
+        Note that these coefficients depend on the sample size, so the tree must not be re-used across samples of different sizes.
+    dtype : NumPy dtype, optional
+        Data type used to accumulate the elementwise products and power sums.
+        Use float32 to halve memory traffic on large samples, or longdouble for extra precision.
+        Default is the dtype of the data if it is floating point, and float64 otherwise.
+    summation : str, optional
+        Algorithm used to compute the power sums. Either 'pairwise' (NumPy's built-in summation),
+        or 'kahan' (compensated summation, see compensated_sum). Default is 'pairwise'.
+    out : NumPy array, optional
+        Array in which to place the result. Must have the shape of the returned k-statistic.
+    scratch : NumPy array, optional
+        Preallocated buffer for the elementwise products of columns, with the shape of the data
+        array after removing the variable axis. When evaluating many k-stats on the same data,
+        this buffer may be re-used to avoid allocating a new sample-sized array for every block.
+        If dtype is not given, the dtype of this buffer is used; otherwise, the dtypes must match.
+    product_trie : ProductTrie, optional
+        Data structure to cache elementwise products of columns that are shared between blocks.
+        When evaluating many k-stats on the same data (with the same dtype), this trie may be re-used
+        to reduce runtime. By default, a new trie with a 64 MiB budget is used for each call to a k-stat of
+        order 5 or higher; at lower orders, few products are shared, and caching is disabled.
+    terms_tree : IntPartitionTree, optional
+        Efficient data structure to memoize the output of kstat_coef_terms, from which the coefficients are evaluated.
+        Unlike coef_tree, this tree does not depend on the sample size, so it may be re-used across samples of
+        different sizes (e.g., groups or rolling windows) to avoid re-deriving the coefficients for every sample.
 
-    
     Returns
     -------
     k : float, or array of floats
@@ -37,11 +61,35 @@ def kstat(data, modes, sample_axis=0, variable_axis=1, coef_tree=None):
         with the sample axis and variable axis flattened.
     """
 
-    n, d, r = data.shape[sample_axis], data.shape[variable_axis], len(data.shape)
+    n = data.shape[sample_axis]
     if coef_tree is None:
         coef_tree = IntPartitionTree()
-    slice_left, slice_right = (slice(None),) * variable_axis, (slice(None),) * (r - variable_axis - 1)
+    if product_trie is None:
+        product_trie = ProductTrie() if len(modes) >= 5 else ProductTrie(max_bytes=0)
+    if summation == 'pairwise':
+        sum_func = np.sum
+    elif summation == 'kahan':
+        sum_func = compensated_sum
+    else:
+        raise ValueError("summation must be 'pairwise' or 'kahan', not {!r}".format(summation))
+    if dtype is None:
+        if scratch is not None:
+            dtype = scratch.dtype
+        elif np.issubdtype(data.dtype, np.inexact):
+            dtype = data.dtype
+        else:
+            dtype = np.float64
+    dtype = np.dtype(dtype)
+    scratch_shape = data.shape[:variable_axis] + data.shape[variable_axis + 1:]
+    if scratch is None:
+        scratch = np.empty(scratch_shape, dtype=dtype)
+    elif scratch.shape != scratch_shape or scratch.dtype != dtype:
+        raise ValueError("scratch must have shape {} and dtype {}, not shape {} and dtype {}".format(
+            scratch_shape, dtype, scratch.shape, scratch.dtype))
     true_sample_axis = sample_axis if sample_axis < variable_axis else sample_axis - 1
+    out_shape = scratch_shape[:true_sample_axis] + scratch_shape[true_sample_axis + 1:]
+    if out is not None and out.shape != out_shape:
+        raise ValueError("out must have shape {}, not {}".format(out_shape, out.shape))
     k = 0
     for pi in set_partitions(modes):
 
@@ -49,22 +97,101 @@ def kstat(data, modes, sample_axis=0, variable_axis=1, coef_tree=None):
         block_sizes = [len(block) for block in pi]
         coef = coef_tree.get_coef(block_sizes)
         if coef is None:
-            coef = kstat_coef(n, block_sizes)
+            coef = kstat_coef(n, block_sizes, terms_tree=terms_tree)
             coef_tree.set_coef(block_sizes, coef)
 
         # Compute the power sum product
         power_sum_product = 1
         for block in pi:
-            data_slice = slice_left + (block,) + slice_right
-            power_sum = np.sum(np.prod(data[data_slice], axis=variable_axis), axis=true_sample_axis)
+            product = product_trie.product(data, block, variable_axis, out=scratch)
+            power_sum = sum_func(product, axis=true_sample_axis, dtype=dtype)
             power_sum_product *= power_sum
 
         k += coef * power_sum_product
 
+    if out is not None:
+        out[...] = k
+        return out
     return k
 
 
-def kstat_coef(n, block_sizes):
+def compensated_sum(x, axis=0, dtype=None, n_runs=32):
+    """
+    Sum an array along an axis, using compensated (Kahan-style) summation.
+
+    Parameters
+    ----------
+    x : NumPy array
+        Array to sum.
+    axis : int, optional
+        Axis along which to sum. Default is 0.
+    dtype : NumPy dtype, optional
+        Data type of the accumulator. Default is the dtype of x.
+    n_runs : int, optional
+        Number of consecutive runs into which the array is split at each level. Default is 32.
+
+    Returns
+    -------
+    s : float, or array of floats
+        Sum of x along the given axis.
+
+    Notes
+    -----
+    Compensating every addition one element at a time would require a Python-level loop
+    over the entire sample. Instead, the n elements are split into n_runs consecutive runs,
+    which are added together lane-by-lane with vectorized error-free transformations (TwoSum).
+    The n / n_runs lane sums are then combined recursively in the same manner, so the whole
+    sum takes about n_runs * log(n) / log(n_runs) NumPy calls, and keeps the rounding error
+    independent of n. If the sum is not finite, the result agrees with np.sum.
+    """
+    dtype = x.dtype if dtype is None else np.dtype(dtype)
+    total, error = _compensated_sum(np.moveaxis(x, axis, 0), dtype, n_runs)
+    total = np.array(total, dtype=dtype)
+    np.add(total, error, out=total, where=np.isfinite(error))
+    return total[()] if total.ndim == 0 else total
+
+
+def _compensated_sum(x, dtype, n_runs):
+    """
+    Sum an array along the first axis, returning the (uncompensated) sum and the total rounding error separately.
+    Adding the rounding error only once, at the end, avoids double rounding between the levels of the recursion.
+    """
+    n = x.shape[0]
+    n_lanes = max(1, -(-n // n_runs))
+
+    # Accumulate consecutive runs of the data into side-by-side lanes
+    s = np.zeros((n_lanes,) + x.shape[1:], dtype=dtype)
+    c, u, v, w = np.zeros_like(s), np.empty_like(s), np.empty_like(s), np.empty_like(s)
+    with np.errstate(invalid='ignore'):
+        for i in range(0, n, n_lanes):
+            run = x[i:i + n_lanes]
+            m = len(run)
+            _two_sum(s[:m], c[:m], run, u[:m], v[:m], w[:m])
+    error = np.sum(c, axis=0, dtype=dtype)
+
+    # Combine the lanes
+    if n_lanes == 1:
+        return s[0], error
+    total, lane_error = _compensated_sum(s, dtype, n_runs)
+    return total, error + lane_error
+
+
+def _two_sum(s, c, t, u, v, w):
+    """
+    Add t to the running sum s in-place, accumulating the exact rounding error in c.
+    The arrays u, v and w are scratch buffers with the same shape as s.
+    """
+    np.add(s, t, out=u, dtype=s.dtype)
+    np.subtract(u, s, out=v)
+    np.subtract(u, v, out=w)
+    np.subtract(s, w, out=w)
+    np.subtract(t, v, out=v, dtype=s.dtype)
+    np.add(w, v, out=w)
+    np.add(c, w, out=c)
+    np.copyto(s, u)
+
+
+def kstat_coef(n, block_sizes, terms_tree=None):
     """
     Compute the coefficient for a product of power sums in the k-stat formula.
 
@@ -74,16 +201,97 @@ def kstat_coef(n, block_sizes):
         Size of the sample.
     block_sizes : sequence of ints
         Sizes of each block in the partition.
+    terms_tree : IntPartitionTree, optional
+        Efficient data structure to memoize the output of kstat_coef_terms.
+        This tree does not depend on the sample size, so it may be re-used across samples of different sizes.
 
     Returns
     -------
     c : float
         Coefficient in the k-stat formula.
     """
+    terms = _get_coef_terms(block_sizes, terms_tree)
+    return sum(terms[s] / ff(n, s) for s in range(len(block_sizes), len(terms)))
+
+
+def kstat_coefs(n, block_sizes, terms_tree=None):
+    """
+    Compute the coefficient for a product of power sums in the k-stat formula, for many sample sizes at once.
+
+    Parameters
+    ----------
+    n : int, or array of ints
+        Sizes of the samples.
+    block_sizes : sequence of ints
+        Sizes of each block in the partition.
+    terms_tree : IntPartitionTree, optional
+        Efficient data structure to memoize the output of kstat_coef_terms.
+        Unlike the coef_tree argument of kstat, this tree does not depend on the sample size,
+        so it may be re-used across samples of different sizes.
+
+    Returns
+    -------
+    c : float, or array of floats
+        Coefficients in the k-stat formula, with the same shape as n.
+
+    Notes
+    -----
+    The coefficient is evaluated from the terms of kstat_coef_terms with Horner's scheme,
+        c = ( a_lb + ( a_(lb+1) + ( ... ) / (n-lb-1) ) / (n-lb) ) / (n)_lb,
+    where lb is the number of blocks. This takes O(|pi|) vectorized operations, regardless of
+    how many sample sizes are given. The coefficient is undefined if n is smaller than the
+    order of the k-statistic.
+    """
+    terms = _get_coef_terms(block_sizes, terms_tree)
+    n = np.asarray(n, dtype=float)
+    lb, ub = len(block_sizes), len(terms) - 1
+    c = np.full(n.shape, float(terms[ub]))
+    for s in range(ub - 1, lb - 1, -1):
+        c = float(terms[s]) + c / (n - s)
+    for j in range(lb):
+        c /= n - j
+    return c[()] if c.ndim == 0 else c
+
+
+def _get_coef_terms(block_sizes, terms_tree=None):
+    """
+    Look up the output of kstat_coef_terms in a memoization tree, computing and storing it if necessary.
+    """
+    terms = None if terms_tree is None else terms_tree.get_coef(block_sizes)
+    if terms is None:
+        terms = kstat_coef_terms(block_sizes)
+        if terms_tree is not None:
+            terms_tree.set_coef(block_sizes, terms)
+    return terms
+
+
+def kstat_coef_terms(block_sizes):
+    """
+    Compute the coefficient for a product of power sums in the k-stat formula, as a rational function of n.
+
+    Parameters
+    ----------
+    block_sizes : sequence of ints
+        Sizes of each block in the partition.
+
+    Returns
+    -------
+    terms : tuple of ints
+        Integers a_0, a_1, ..., a_m, where m = sum(block_sizes), such that the coefficient for a
+        sample of size n is a_0 / (n)_0 + a_1 / (n)_1 + ... + a_m / (n)_m.
+        The terms a_s with s < len(block_sizes) are always zero.
+
+    Notes
+    -----
+    None of the terms depend on n, so they only need to be computed once per integer partition.
+    The product of the Stirling number and factorial for each block, divided by b[k], is the
+    integer S(block_size, b[k]) * (b[k] - 1)!, so all of the arithmetic here is exact.
+    """
 
     # Iterate over the sum of the indices b1, b2, ..., b|pi|
-    sum_over_sizes = 0
     lb, ub = len(block_sizes), sum(block_sizes)
+    sign = -1 if lb % 2 == 0 else 1
+    terms = [0] * (ub + 1)
     for s in range(lb, ub+1):
 
         # Iterate over indices that sum to s
@@ -99,13 +307,10 @@ def kstat_coef(n, block_sizes):
                 for i_odd in range(2, b[k], 2):
                     stir2_times_fac += binom(b[k], i_odd) * ((b[k] - i_odd) ** block_sizes[k])
 
-                product_over_blocks *= stir2_times_fac / b[k]
+                product_over_blocks *= stir2_times_fac // b[k]
 
             sum_over_simplex += product_over_blocks
 
-        sum_over_sizes += factorial(s-1) * sum_over_simplex / ff(n, s)
+        terms[s] = sign * factorial(s-1) * sum_over_simplex
 
-    if len(block_sizes) % 2 == 0:
-        return -sum_over_sizes
-    else:
-        return sum_over_sizes
+    return tuple(terms)
@@ -1,8 +1,9 @@
 from unittest import TestCase
 from PyMoments.Moments import *
-from PyMoments.DataStructures import IntPartitionTree
+from PyMoments.DataStructures import IntPartitionTree, ProductTrie
 from numpy.testing import assert_array_almost_equal
 import os.path
+import math
 
 
 class TestMoments(TestCase):
@@ -64,6 +65,90 @@ class TestMoments(TestCase):
                 modes += (i,) * alphas[t, i]
             assert_array_almost_equal(K(modes), true_kstats[t], decimal=5)
 
+    def test_kstat_dtype_and_summation(self):
+
+        # Create random dataset
+        m, d, n = 4, 3, 5000
+        X = np.random.randn(m, d, n) + 3
+        modes_list = [(0,), (0, 1), (0, 1, 2), (2, 2, 1, 0)]
+        K = lambda modes, **kwargs: kstat(X, modes, sample_axis=2, variable_axis=1, **kwargs)
+
+        for modes in modes_list:
+            k_ref = K(modes)
+
+            # Compensated summation should agree with pairwise summation
+            assert_array_almost_equal(K(modes, summation='kahan'), k_ref)
+
+            # Extended and reduced precision
+            k_ld = K(modes, dtype=np.longdouble)
+            self.assertEqual(k_ld.dtype, np.longdouble)
+            assert_array_almost_equal(k_ld, k_ref)
+            k_32 = K(modes, dtype=np.float32, summation='kahan')
+            self.assertEqual(k_32.dtype, np.float32)
+            assert_array_almost_equal(k_32, k_ref, decimal=2)
+
+        # Preallocated output and scratch buffers
+        out = np.empty((m,))
+        scratch = np.empty((m, n))
+        for modes in modes_list:
+            k = K(modes, out=out, scratch=scratch)
+            self.assertIs(k, out)
+            assert_array_almost_equal(k, K(modes))
+
+        with self.assertRaises(ValueError):
+            K((0,), summation='magic')
+
+        # Mismatched buffers
+        with self.assertRaises(ValueError):
+            K((0, 1), dtype=np.float64, scratch=np.empty((m, n), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            K((0, 1), scratch=np.empty((m, n + 1)))
+        with self.assertRaises(ValueError):
+            K((0, 1), out=np.empty((m, 1)))
+
+    def test_kstat_product_trie(self):
+
+        # Re-use one product trie across many k-stats, with a budget that forces evictions
+        m, d, n = 3, 4, 200
+        X = np.random.randn(m, d, n)
+        product_trie = ProductTrie(max_bytes=3 * m * n * X.itemsize)
+        K = lambda modes, **kwargs: kstat(X, modes, sample_axis=2, variable_axis=1, **kwargs)
+        for modes in [(0, 1, 2, 3), (3, 2, 1, 0, 0), (1, 1, 2, 2, 3, 3), (0, 1, 2, 3, 0, 1)]:
+            k_ref = K(modes, product_trie=ProductTrie(max_bytes=0))
+            assert_array_almost_equal(K(modes, product_trie=product_trie), k_ref)
+            self.assertLessEqual(product_trie.n_bytes, product_trie.max_bytes)
+        self.assertGreater(product_trie.n_entries(), 0)
+
+        # Re-using the trie on different data must not return stale products
+        Y = np.random.randn(m, d, n)
+        assert_array_almost_equal(
+            kstat(Y, (0, 1, 0, 1), sample_axis=2, variable_axis=1, product_trie=product_trie),
+            kstat(Y, (0, 1, 0, 1), sample_axis=2, variable_axis=1, product_trie=ProductTrie(max_bytes=0)))
+
+    def test_compensated_sum(self):
+
+        # Compare against exactly-rounded summation
+        x = np.random.randn(10000) * np.logspace(-8, 8, 10000)
+        self.assertAlmostEqual(compensated_sum(x), math.fsum(x), delta=1e-15 * np.sum(np.abs(x)))
+        x32 = np.full((3, 100000), 0.1, dtype=np.float32)
+        s32 = compensated_sum(x32, axis=1)
+        self.assertEqual(s32.dtype, np.float32)
+        for i in range(3):
+            self.assertEqual(s32[i], np.float32(math.fsum(x32[i])))
+
+        # Empty sums
+        assert_array_almost_equal(compensated_sum(np.zeros((0, 3))), np.zeros(3))
+
+        # Non-finite sums should agree with np.sum, without warnings
+        x_inf = np.array([[1, np.inf, 2], [np.inf, 3, -np.inf], [1, 2, 3], [np.nan, 1, 1]]).T
+        with np.errstate(all='raise'):
+            s_inf = compensated_sum(x_inf, axis=0)
+        with np.errstate(invalid='ignore'):
+            np.testing.assert_array_equal(s_inf, np.sum(x_inf, axis=0))
+        X = np.random.randn(100, 2)
+        X[3, 0] = np.inf
+        self.assertEqual(kstat(X, (0,), summation='kahan'), np.inf)
+
     def test_kstat_coef(self):
 
         # Coefficients from mean
@@ -93,3 +178,44 @@ class TestMoments(TestCase):
         self.assertAlmostEqual(kstat_coef(10, [2, 2]), -1/56)
         self.assertAlmostEqual(kstat_coef(4, [1, 3]), -5/6)
         self.assertAlmostEqual(kstat_coef(10, [1, 3]), -11/(9*8*7))
+
+    def test_kstat_terms_tree(self):
+
+        # Re-use one terms tree across samples of different sizes
+        terms_tree = IntPartitionTree()
+        modes = (0, 1, 1, 2)
+        for n in [10, 37, 200, 1000]:
+            X = np.random.randn(n, 3)
+            k = kstat(X, modes, terms_tree=terms_tree)
+            assert_array_almost_equal(k, kstat(X, modes))
+            self.assertEqual(terms_tree.get_coef([1, 1, 2]), kstat_coef_terms([1, 1, 2]))
+            self.assertAlmostEqual(kstat_coef(n, [1, 3], terms_tree=terms_tree), kstat_coef(n, [1, 3]))
+
+        # Cached terms are used instead of being re-derived
+        terms_tree.set_coef([1, 1, 1, 1], (0, 0, 0, 0, 0))
+        self.assertEqual(kstat_coef(50, [1, 1, 1, 1], terms_tree=terms_tree), 0)
+        terms_tree.set_coef([2], (0, 0, 0))
+        terms_tree.set_coef([1, 1], (0, 0, 0))
+        self.assertEqual(kstat(np.random.randn(50, 1), (0, 0), terms_tree=terms_tree), 0)
+
+    def test_kstat_coef_terms(self):
+
+        self.assertTupleEqual(kstat_coef_terms([1]), (0, 1))
+        self.assertTupleEqual(kstat_coef_terms([1, 1]), (0, 0, -1))
+        self.assertTupleEqual(kstat_coef_terms([2]), (0, 1, 1))
+
+    def test_kstat_coefs(self):
+
+        # Vectorized coefficients should match the scalar coefficients
+        ns = np.arange(8, 200)
+        terms_tree = IntPartitionTree()
+        for block_sizes in [[1], [2], [1, 1], [1, 2], [3], [1, 1, 1, 1], [2, 2], [1, 3], [2, 3, 1], [1, 1, 1, 2, 2]]:
+            c = kstat_coefs(ns, block_sizes, terms_tree=terms_tree)
+            self.assertTupleEqual(c.shape, ns.shape)
+            c_true = np.array([kstat_coef(int(n), block_sizes) for n in ns])
+            np.testing.assert_allclose(c, c_true, rtol=1e-12)
+            self.assertEqual(terms_tree.get_coef(block_sizes), kstat_coef_terms(block_sizes))
+
+        # Scalar sample sizes
+        self.assertAlmostEqual(kstat_coefs(10, [1, 3]), -11/(9*8*7))
+        self.assertAlmostEqual(kstat_coefs(4, [1, 1, 2], terms_tree=terms_tree), 1/3)
@@ -0,0 +1,78 @@
+from unittest import TestCase
+from PyMoments.DataStructures import ProductTrie
+from numpy.testing import assert_array_almost_equal
+import numpy as np
+
+
+class TestProductTrie(TestCase):
+
+    def setUp(self):
+
+        # Random data, with variables along the columns
+        self.X = np.random.randn(100, 5)
+        self.out = np.empty((100,))
+
+    def test_product(self):
+
+        T = ProductTrie()
+        blocks = [(0,), (1, 0), (0, 1, 2), (2, 1, 0), (0, 1, 2, 3), (3, 3, 4), (4, 3, 3), (0, 1, 2, 3, 4)]
+        for block in blocks:
+            p = T.product(self.X, block, 1, out=self.out)
+            assert_array_almost_equal(p, np.prod(self.X[:, block], axis=1))
+
+        # Only prefixes requested at least twice are cached
+        self.assertSetEqual(set(T.cache.keys()), {(0, 1), (0, 1, 2), (3, 3), (3, 3, 4), (0, 1, 2, 3)})
+        self.assertEqual(T.n_entries(), 5)
+        self.assertEqual(T.n_bytes, 5 * self.out.nbytes)
+
+        # Cached products are returned directly
+        self.assertIsNot(T.product(self.X, (2, 0, 1), 1, out=self.out), self.out)
+
+    def test_eviction(self):
+
+        # Budget for two cached products
+        T = ProductTrie(max_bytes=2 * self.out.nbytes, min_count=1)
+        for block in [(0, 1), (2, 3), (0, 1), (1, 4)]:
+            p = T.product(self.X, block, 1, out=self.out)
+            assert_array_almost_equal(p, np.prod(self.X[:, block], axis=1))
+            self.assertLessEqual(T.n_bytes, T.max_bytes)
+        self.assertListEqual(list(T.cache.keys()), [(0, 1), (1, 4)])
+        self.assertIsNone(T.root.children[2].children[3].value)
+
+        # Caching disabled
+        T = ProductTrie(max_bytes=0)
+        for block in [(0, 1, 2), (0, 1, 2), (0, 1, 2)]:
+            p = T.product(self.X, block, 1, out=self.out)
+            assert_array_almost_equal(p, np.prod(self.X[:, block], axis=1))
+        self.assertEqual(T.n_entries(), 0)
+
+    def test_data_change(self):
+
+        T = ProductTrie(min_count=1)
+        T.product(self.X, (0, 1), 1, out=self.out)
+        self.assertEqual(T.n_entries(), 1)
+
+        # Cached products must never alias the caller's buffer
+        self.assertIsNot(T.cache[(0, 1)].value, self.out)
+
+        # A different data array with the same shape clears the cache
+        Y = np.random.randn(100, 5)
+        p = T.product(Y, (0, 1), 1, out=self.out)
+        assert_array_almost_equal(p, Y[:, 0] * Y[:, 1])
+        self.assertIs(T.data_ref(), Y)
+
+        # So does a different accumulation dtype
+        out32 = np.empty((100,), dtype=np.float32)
+        p = T.product(Y, (0, 1), 1, out=out32)
+        self.assertEqual(p.dtype, np.float32)
+        self.assertEqual(T.data_signature, ((100, 5), 1, np.float32))
+
+    def test_clear(self):
+
+        T = ProductTrie(min_count=1)
+        T.product(self.X, (0, 1), 1, out=self.out)
+        self.assertEqual(T.n_entries(), 1)
+        T.clear()
+        self.assertEqual(T.n_entries(), 0)
+        self.assertEqual(T.n_bytes, 0)
+        self.assertDictEqual(T.root.children, {})